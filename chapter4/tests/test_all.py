@@ -11,6 +11,7 @@ import sync
     "producer_consumer_finite_buffer.py",
     "reader_writer.py",
     "reader_writer_no_starvation.py",
+    "reader_writer_no_starvation_ds.py",
 ])
 @settings(suppress_health_check=[HealthCheck.function_scoped_fixture])
 @given(random=st.random_module())
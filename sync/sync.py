@@ -7,19 +7,35 @@ Copyright 2011 Allen B. Downey
 Distributed under the GNU General Public License at gnu.org/licenses/gpl.html.
 """
 
-from collections import ChainMap
+from collections import deque
 from dataclasses import dataclass
+from functools import partial
+import ast
 import os
 import copy
 import random
 import re
 import sys
 import string
+import textwrap
 import time
+import types
 
 # the following definitions can be accessed in the simulator
 
-current_thread = None
+class CurrentThread:
+    """Holds the thread that is running a line of code.
+
+    Thread.exec_line sets the attribute rather than rebinding a global.
+    """
+
+    __slots__ = ("thread",)
+
+    def __init__(self):
+        self.thread = None
+
+
+_current = CurrentThread()
 
 
 def noop(*args):
@@ -28,7 +44,7 @@ def noop(*args):
 
 def balk():
     """Jumps to the top of the column."""
-    current_thread.balk()
+    _current.thread.balk()
 
 
 class Semaphore:
@@ -51,7 +67,7 @@ class Semaphore:
         return self.n
 
     def block(self):
-        thread = current_thread
+        thread = _current.thread
         thread.enqueue()
         self.queue.append(thread)
 
@@ -63,8 +79,13 @@ class Semaphore:
 
     def unblock(self):
         """Chooses a random thread and unblocks it."""
-        thread = random.choice(self.queue)
-        self.queue.remove(thread)
+        # the queue is unordered, so fill the gap with the last thread
+        # rather than shifting everything after it along
+        i = random.randrange(len(self.queue))
+        thread = self.queue[i]
+        last = self.queue.pop()
+        if i < len(self.queue):
+            self.queue[i] = last
         thread.dequeue()
         thread.next_loop()
 
@@ -72,9 +93,13 @@ class Semaphore:
 class FifoSemaphore(Semaphore):
     """Semaphore that implements a FIFO queue."""
 
+    def __init__(self, n=0):
+        super().__init__(n)
+        self.queue = deque()
+
     def unblock(self):
         """Chooses the first thread and unblocks it."""
-        thread = self.queue.pop(0)
+        thread = self.queue.popleft()
         thread.dequeue()
         thread.next_loop()
 
@@ -133,12 +158,12 @@ class Barrier:
 
 def pid():
     """Gets the ID of the current thread."""
-    return current_thread.name
+    return _current.thread.name
 
 
 def num_threads():
     """Gets the number of threads."""
-    sync = current_thread.column.p
+    sync = _current.thread.column.p
     return len(sync.threads)
 
 
@@ -164,7 +189,7 @@ START_NEW_LINE = re.compile(r'##\s*thread\s+(.*?)(?:\s*\*\s*(\d+))?\s*$', re.I)
 
 @dataclass
 class Options:
-    delay: float = 0.2
+    delay: float = 0.0
     max_steps: int = None
     roundrobin: bool = False
     verbose: bool = False
@@ -178,10 +203,19 @@ class Sync:
     def __init__(self, options, filename):
         self.options = options
         self.filename = filename
-        self.locals = sim_locals
+        self.locals = TrackedDict(sim_locals)
         self._globals = sim_globals
-
-        self.threads = []
+        self._variables = self.locals.merge_over(self._globals)
+
+        # registered threads, as an ordered set; names needn't be unique
+        self.threads = {}
+        # threads that aren't queued, and where each one is in that list,
+        # so that threads can be added and removed in O(1)
+        self.runnable = []
+        self.runnable_index = {}
+        self.code_cache = {}
+        # what Thread works out from each list of instructions, by id
+        self.blocks = {}
         self.running = False
         self.delay = self.options.delay
         self.max_steps = self.options.max_steps
@@ -200,11 +234,34 @@ class Sync:
         # applied to the `locals` mapping, so we must retain `self.locals`.
         #
         # Also, `eval`/`exec` will accept a ChainMap of locals, but not
-        # globals. So we must cast this to a dict. Screw you, Python 3.
-        return dict(ChainMap(self._globals, self.locals))
+        # globals. So we must flatten this into a dict. Screw you, Python 3.
+        # Rather than rebuilding it every step, self.locals keeps a merged
+        # copy up to date as it is written to. Functions and classes keep
+        # their globals, so code that defines them is run with a copy, and
+        # sees top-level variables as they were when it ran.
+        return self._variables
+
+    def compile(self, source, mode="exec"):
+        """Compiles a line of user code, reusing the result for repeat calls.
+
+        Lines that fail to compile are cached too, and the same SyntaxError
+        is raised again on each call.
+        """
+        key = (source, mode)
+        try:
+            code = self.code_cache[key]
+        except KeyError:
+            try:
+                code = compile(source, "<user-provided code>", mode)
+            except SyntaxError as error:
+                code = error
+            self.code_cache[key] = code
+        if isinstance(code, SyntaxError):
+            raise code.with_traceback(None)
+        return code
 
     def get_threads(self):
-        return self.threads
+        return list(self.threads)
 
     def setup(self):
         """Reads in the code."""
@@ -215,13 +272,34 @@ class Sync:
         """Adds a new thread."""
         if self.options.verbose:
             print(f"Registering thread {thread.name}")
-        self.threads.append(thread)
+        self.threads[thread] = None
+        if not thread.queued:
+            self.add_runnable(thread)
 
     def unregister(self, thread):
         """Removes a thread."""
         if self.options.verbose:
             print(f"Removing thread {thread.name}")
-        self.threads.remove(thread)
+        self.remove_runnable(thread)
+        del self.threads[thread]
+
+    def add_runnable(self, thread):
+        """Makes a registered thread eligible for random_step."""
+        if thread in self.runnable_index or thread not in self.threads:
+            return
+        self.runnable_index[thread] = len(self.runnable)
+        self.runnable.append(thread)
+
+    def remove_runnable(self, thread):
+        """Stops random_step from choosing a thread."""
+        i = self.runnable_index.pop(thread, None)
+        if i is None:
+            return
+        # the list is unordered, so fill the gap with the last thread
+        last = self.runnable.pop()
+        if last is not thread:
+            self.runnable[i] = last
+            self.runnable_index[last] = i
 
     def run(self):
         """Runs the simulator."""
@@ -231,18 +309,25 @@ class Sync:
 
     def run_helper(self, stepper, thread_stepper):
         """Runs the threads until someone clears self.running."""
+        # this loop runs once per simulated line, so look everything up
+        # once beforehand
         self.running = True
+        threads = self.threads
+        verbose = self.options.verbose
+        delay = self.delay
+        max_steps = float("inf") if self.max_steps is None else self.max_steps
         step_count = 0
         while self.running:
-            if not self.threads:
-                if self.options.verbose:
+            if not threads:
+                if verbose:
                     print("All threads finished, exiting")
                 return
             stepper(thread_stepper)
-            time.sleep(self.delay)
+            if delay > 0:
+                time.sleep(delay)
             step_count += 1
-            if self.max_steps is not None and step_count >= self.max_steps:
-                if self.options.verbose:
+            if step_count >= max_steps:
+                if verbose:
                     print("Reached max_steps, exiting")
                 self.running = False
 
@@ -258,18 +343,18 @@ class Sync:
 
     def step(self, thread_stepper):
         """Advances all the threads in order"""
-        for thread in self.threads:
+        # copy, since finished threads are unregistered as we go
+        for thread in list(self.threads):
             thread_stepper(thread)
 
     def random_step(self, thread_stepper):
         """Advances one random thread."""
-        threads = [thread for thread in self.threads if not thread.queued]
-        if not threads:
+        if not self.runnable:
             print("There are currently no threads that can run.")
             if self.options.no_deadlocks:
-                assert False, f"Threads {self.threads} are deadlocked - failing"
+                assert False, f"Threads {self.get_threads()} are deadlocked - failing"
             return
-        thread = random.choice(threads)
+        thread = random.choice(self.runnable)
         thread_stepper(thread)
 
     def stop(self):
@@ -292,7 +377,8 @@ class Sync:
         for line in fp:
             line = line.rstrip()
 
-            m = START_NEW_LINE.match(line)
+            # only try the regex on lines that could possibly match it
+            m = START_NEW_LINE.match(line) if line.startswith("##") else None
             if m:
                 self.create_threads(block, name, thread_count)
                 block = []
@@ -319,57 +405,137 @@ class Sync:
         if self.options.verbose:
             print("running init")
 
-        thread = self.threads[0]
+        thread = next(iter(self.threads))
         thread.run()
 
         self.unregister(thread)
 
 
-def subtract(d1, d2):
-    """Subtracts two dictionaries.
+def trim_block(block):
+    """Removes comments from the beginning and empty lines from the end."""
+    if block and block[0].startswith("#"):
+        block.pop(0)
+
+    while block and not block[-1].strip():
+        block.pop(-1)
+
+
+MISSING = object()
 
-    Returns a new dictionary containing all the keys from
-    d1 that are not in d2.
+
+def makes_functions(code):
+    """Checks whether running code can create functions or classes.
+
+    These hold on to the globals they were created with.
     """
-    d = {}
-    for key in d1:
-        if key not in d2:
-            d[key] = d1[key]
-    return d
+    return any(isinstance(const, types.CodeType) for const in code.co_consts)
+
 
+def diff_writes(writes, get):
+    """Diffs a record of writes against the current values.
 
-def diff_dict(d1, d2):
-    """Diffs two dictionaries.
+    Args:
+        writes: maps each key written to the value it had before the
+                first write, or MISSING if it was undefined
+        get: function that looks up the current value of a key,
+             with the same signature as dict.get
 
-    Returns two dictionaries: the first contains all the keys
-    from d1 that are not in d2; the second contains all the keys
-    that are in both dictionaries, but which have different values.
+    Returns two dictionaries: the keys that were defined, and the
+    keys whose values changed.
     """
     d = {}
     c = {}
-    for key in d1:
-        if key not in d2:
-            d[key] = d1[key]
-        elif d1[key] is not d2[key]:
-            c[key] = d1[key]
+    for key, old in writes.items():
+        new = get(key, MISSING)
+        if new is MISSING:
+            continue
+        if old is MISSING:
+            d[key] = new
+        elif new is not old:
+            c[key] = new
     return d, c
 
 
-def trim_block(block):
-    """Removes comments from the beginning and empty lines from the end."""
-    if block and block[0].startswith("#"):
-        block.pop(0)
+def track_writes(obj, writes):
+    """Starts recording writes to a TrackedDict or Namespace into writes.
+
+    Pass writes=None to stop recording.
+    """
+    object.__setattr__(obj, "_writes", writes)
 
-    while block and not block[-1].strip():
-        block.pop(-1)
+
+class TrackedDict(dict):
+    """A dict that can record which keys are written to.
+
+    See track_writes and diff_writes.  It can also keep a merged copy of
+    another mapping overlaid with its own items up to date; see merge_over.
+    Only item assignment and deletion are tracked, which is all that
+    exec needs.
+    """
+
+    _writes = None
+    _base = None
+    _merged = None
+
+    def merge_over(self, base):
+        """Returns a dict of base overlaid with this dict's items.
+
+        The returned dict is updated whenever this dict is written to.
+        base is assumed not to change.
+        """
+        self._base = base
+        self._merged = {**base, **self}
+        return self._merged
+
+    def __setitem__(self, key, value):
+        writes = self._writes
+        if writes is not None and key not in writes:
+            writes[key] = self.get(key, MISSING)
+        super().__setitem__(key, value)
+        if self._merged is not None:
+            self._merged[key] = value
+
+    def __delitem__(self, key):
+        writes = self._writes
+        if writes is not None and key not in writes:
+            writes[key] = self.get(key, MISSING)
+        super().__delitem__(key)
+        if self._merged is not None:
+            if key in self._base:
+                self._merged[key] = self._base[key]
+            else:
+                self._merged.pop(key, None)
 
 
 class Namespace:
     """Used to store thread-local variables.
 
     Inside the simulator, self refers to the thread's namespace.
+    Each thread uses a subclass with slots for the attributes its code
+    assigns; see Thread.make_namespace_class.
+    """
+
+
+class TrackedNamespace(Namespace):
+    """A Namespace whose writes can be recorded, as for TrackedDict.
+
+    Only used in verbose mode, since it slows down every assignment.
     """
 
+    _writes = None
+
+    def __setattr__(self, name, value):
+        writes = self._writes
+        if writes is not None and name not in writes:
+            writes[name] = getattr(self, name, MISSING)
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        writes = self._writes
+        if writes is not None and name not in writes:
+            writes[name] = getattr(self, name, MISSING)
+        super().__delattr__(name)
+
 
 class Thread:
     """Represents simulated threads."""
@@ -379,19 +545,53 @@ class Thread:
         self.instructions = instructions
         self.name = name
         self.looping = looping
-        self.namespace = Namespace()
-        self.flag_map = {}
-        self.while_stack = []
-        self._iptr = 0
+        # the instructions don't change, so work out their layout up front;
+        # copies of a thread share the same list, so they share this too
+        key = id(instructions)
+        if key in sync.blocks:
+            (_, self.indents, self.is_blank, self.body_ends, self.ops,
+             namespace_class, max_indent) = sync.blocks[key]
+        else:
+            self.indents = [self.count_spaces(source) for source in instructions]
+            self.is_blank = [source == "" for source in instructions]
+            self.body_ends = [self.find_body_end(i) for i in range(len(instructions))]
+            self.ops = [self.classify(row) for row in range(len(instructions))]
+            namespace_class = self.make_namespace_class()
+            max_indent = max(self.indents, default=0)
+            # keep instructions alive so that its id isn't reused
+            sync.blocks[key] = (instructions, self.indents, self.is_blank,
+                                self.body_ends, self.ops, namespace_class,
+                                max_indent)
+        self.namespace = namespace_class()
+        # conditions and loops are tracked by the indent of their header
+        self.if_flags = [MISSING] * (max_indent + 1)
+        self.while_rows = [-1] * (max_indent + 1)
+        self.while_indents = []
+        self.iptr = 0
         self.start()
 
-    @property
-    def iptr(self):
-        return self._iptr
+    def make_namespace_class(self):
+        """Makes the class of the namespace for this thread's variables.
 
-    @iptr.setter
-    def iptr(self, value):
-        self._iptr = value
+        Attributes that this thread's code assigns to self get slots;
+        any others still work, but are stored in the instance __dict__.
+        """
+        base = TrackedNamespace if self.sync.options.verbose else Namespace
+        names = set()
+        for source in self.instructions:
+            try:
+                tree = ast.parse(source.strip())
+            except SyntaxError:
+                continue
+            for node in ast.walk(tree):
+                if (isinstance(node, ast.Attribute)
+                        and isinstance(node.ctx, ast.Store)
+                        and isinstance(node.value, ast.Name)
+                        and node.value.id == "self"
+                        and not node.attr.startswith("__")
+                        and not hasattr(base, node.attr)):
+                    names.add(node.attr)
+        return type("Namespace", (base,), {"__slots__": tuple(sorted(names))})
 
     def __repr__(self):
         return f"<{self.name} {self.iptr}>"
@@ -399,10 +599,12 @@ class Thread:
     def enqueue(self):
         """Puts this thread into queue."""
         self.queued = True
+        self.sync.remove_runnable(self)
 
     def dequeue(self):
         """Removes this thread from queue."""
         self.queued = False
+        self.sync.add_runnable(self)
 
     def jump_to(self, row):
         """Removes this thread from its current row and moves it to row."""
@@ -414,6 +616,7 @@ class Thread:
     def start(self):
         """Moves this thread to the top of the column."""
         self.queued = False
+        self.sync.add_runnable(self)
         self.iptr = 0
 
     def next_loop(self):
@@ -431,43 +634,44 @@ class Thread:
 
     def skip_body(self):
         """Skips an indented block."""
-        # get the current line
-        # get the next line
-        # compute the change in indent
-        # find the outdent
         if self.finished:
-            return []
-        source = self.instructions[self.iptr]
-        lines = [source]
-        head_indent = self.count_spaces(source)
-
-        while True:
-            self.next_row()
-            if self.finished:
-                return lines
-            source = self.instructions[self.iptr]
-            if source != "":
-                break
-
-        body_indent = self.count_spaces(source)
-        indent = body_indent - head_indent
-
-        if indent <= 0:
+            return
+        end = self.body_end()
+        if not self.queued:
+            self.iptr = end
+
+    def body_end(self):
+        """Returns the row after the block headed by the current row."""
+        end = self.body_ends[self.iptr]
+        if end is None:
             raise SyntaxError("Body of compound statement must be indented.")
+        return end
 
-        while True:
-            lines.append(source)
-            self.next_row()
-            if self.finished:
-                break
+    def find_body_end(self, start):
+        """Finds the end of the indented block that starts at a row.
 
-            source = self.instructions[self.iptr]
-            if source == "":
-                continue
-            line_indent = self.count_spaces(source)
-            if line_indent <= head_indent:
-                break
-        return lines
+        Returns the index of the first row after the block, or None if
+        the first non-blank row after the header is not indented.
+        """
+        indents = self.indents
+        is_blank = self.is_blank
+        n = len(indents)
+        head_indent = indents[start]
+
+        # skip blank lines to find the start of the body,
+        # check it's indented, then find the outdent
+        i = start + 1
+        while i < n and is_blank[i]:
+            i += 1
+        if i == n:
+            return n
+        if indents[i] <= head_indent:
+            return None
+
+        i += 1
+        while i < n and (is_blank[i] or indents[i] > head_indent):
+            i += 1
+        return i
 
     def count_spaces(self, source):
         """Returns the number of leading spaces after expanding tabs."""
@@ -499,19 +703,29 @@ class Thread:
         source = self.instructions[self.iptr]
         print(self, source)
 
-        before = copy.copy(self.sync.locals)
-        before_ns = copy.copy(self.namespace.__dict__)
+        verbose = self.sync.options.verbose
+        if verbose:
+            writes = {}
+            writes_ns = {}
+            track_writes(self.sync.locals, writes)
+            track_writes(self.namespace, writes_ns)
 
-        flag = self.exec_line(source, self.sync)
+        try:
+            flag = self.exec_line(self.ops[self.iptr], self.sync)
+        finally:
+            if verbose:
+                track_writes(self.sync.locals, None)
+                track_writes(self.namespace, None)
 
         # see if any variables were defined or changed
-        after = self.sync.locals
-        defined, changed = diff_dict(after, before)
-        if self.sync.options.verbose and (defined or changed):
-            print(f"{defined} defined, {changed} changed")
-        defined, changed = diff_dict(self.namespace.__dict__, before_ns)
-        if self.sync.options.verbose and (defined or changed):
-            print(f"{self} thread-locals {defined} defined, {changed} changed")
+        if verbose:
+            defined, changed = diff_writes(writes, self.sync.locals.get)
+            if defined or changed:
+                print(f"{defined} defined, {changed} changed")
+            defined, changed = diff_writes(
+                writes_ns, partial(getattr, self.namespace))
+            if defined or changed:
+                print(f"{self} thread-locals {defined} defined, {changed} changed")
 
         # either skip to the next line or to the end of a false conditional
         if flag:
@@ -521,109 +735,144 @@ class Thread:
 
         return source
 
-    def exec_line(self, source, sync):
-        """Runs a line of source code in the context of the given Sync.
+    def classify(self, row):
+        """Works out how to run a line of source code.
+
+        Lines that compile on their own are simple statements; anything
+        else must be the header of a compound statement.
 
         Args:
-            source: source code from a Row
-            sync: Sync object
+            row: index of the line in self.instructions
 
         Returns:
-            if the line is an if statement, returns the result of
-            evaluating the condition
+            a tuple whose first element is the kind of line:
+            ("exec", code, snapshot) for a simple statement, where
+            snapshot says whether it needs a copy of the variables
+            (see makes_functions),
+            ("if", code) or ("while", code) with the compiled condition,
+            ("else",), ("def", code) with the whole compiled definition,
+            or ("error", error) for a line that raises error when run
         """
-        global current_thread
-        current_thread = self
-
-        sync.locals["self"] = self.namespace
-
+        s = self.instructions[row].strip()
         try:
-            s = source.strip()
-            code = compile(s, "<user-provided code>", "exec")
-            exec(code, sync.variables, sync.locals)
-            return True
+            code = self.sync.compile(s)
+            return ("exec", code, makes_functions(code))
         except SyntaxError as error:
-            # check whether it's a conditional statement
             keyword = s.split()[0]
             if keyword in ["if", "else:", "while"]:
-                flag = self.handle_conditional(keyword, source, sync)
-                return flag
+                if not s.endswith(":"):
+                    return ("error", SyntaxError("Header must end with :"))
+                if keyword == "else:":
+                    return ("else",)
+                n = len(keyword)
+                try:
+                    condition = self.sync.compile(s[n:-1].strip(), "eval")
+                except SyntaxError as condition_error:
+                    return ("error", condition_error)
+                return (keyword, condition)
             elif keyword in ["def", "class"]:
-                self.handle_def(sync)
-                return False
+                end = self.body_ends[row]
+                if end is None:
+                    return ("error", SyntaxError(
+                        "Body of compound statement must be indented."))
+                # definitions can be nested in other blocks, so remove
+                # the header's indent before compiling
+                definition = textwrap.dedent(
+                    "\n".join(self.instructions[row:end]) + "\n")
+                try:
+                    return ("def", self.sync.compile(definition))
+                except SyntaxError as definition_error:
+                    return ("error", definition_error)
             else:
-                raise error
+                return ("error", error)
+
+    def exec_line(self, op, sync):
+        """Runs a line of code in the context of the given Sync.
+
+        Args:
+            op: the line, as classified by classify
+            sync: Sync object
 
-    def handle_conditional(self, keyword, source, sync):
+        Returns:
+            if the line is an if statement, returns the result of
+            evaluating the condition
+        """
+        _current.thread = self
+
+        # writes to sync.locals are mirrored into sync.variables, so only
+        # rebind self when another thread has run since this one
+        if sync.locals.get("self") is not self.namespace:
+            sync.locals["self"] = self.namespace
+
+        kind = op[0]
+        if kind == "exec":
+            variables = dict(sync.variables) if op[2] else sync.variables
+            exec(op[1], variables, sync.locals)
+            return True
+        elif kind in ["if", "else", "while"]:
+            return self.handle_conditional(op, sync)
+        elif kind == "def":
+            # run the whole definition, then skip its body
+            exec(op[1], dict(sync.variables), sync.locals)
+            return False
+        else:
+            raise op[1].with_traceback(None)
+
+    def handle_conditional(self, op, sync):
         """Evaluates the condition part of an if statement.
 
         Args:
-            keyword: if, else or while
-            source: source code from a Row
+            op: the header, as classified by classify
             sync: Sync object
 
         Returns:
             if the line is an if statement, returns the result of
             evaluating the condition; otherwise raises a SyntaxError
         """
-        s = source.strip()
-        if not s.endswith(":"):
-            raise SyntaxError("Header must end with :")
-
-        if keyword in ["if"]:
+        kind = op[0]
+        if kind == "if":
             # evaluate the condition
-            n = len(keyword)
-            condition = s[n:-1].strip()
-            flag = eval(condition, sync.variables, sync.locals)
+            flag = eval(op[1], sync.variables, sync.locals)
 
             # store the flag
-            indent = self.count_spaces(source)
-            self.flag_map[indent] = flag
+            indent = self.indents[self.iptr]
+            self.if_flags[indent] = flag
 
             return flag
 
-        elif keyword in ["while"]:
+        elif kind == "while":
             # evaluate the condition
-            n = len(keyword)
-            condition = s[n:-1].strip()
-            flag = eval(condition, sync.variables, sync.locals)
+            flag = eval(op[1], sync.variables, sync.locals)
 
             if flag:
-                indent = self.count_spaces(source)
-                self.while_stack.append((indent, self.iptr))
+                indent = self.indents[self.iptr]
+                self.while_rows[indent] = self.iptr
+                self.while_indents.append(indent)
 
             return flag
 
         else:
-            assert keyword == "else:"
+            assert kind == "else"
             # see whether the condition was true
-            indent = self.count_spaces(source)
-            try:
-                flag = self.flag_map[indent]
-                return not flag
-            except KeyError:
+            indent = self.indents[self.iptr]
+            flag = self.if_flags[indent]
+            if flag is MISSING:
                 raise SyntaxError("else does not match if")
-
-    def handle_def(self, sync):
-        head_line = self.iptr
-        definition = "\n".join(self.skip_body()) + "\n"
-        exec(definition, sync.variables, sync.locals)
-        self.iptr = head_line
+            return not flag
 
     def check_end_while(self):
         """Check if we are at the end of a while loop.
 
         If so, jump to the top.
         """
-        if not self.while_stack:
+        if not self.while_indents:
             return
 
-        indent, row = self.while_stack[-1]
+        indent = self.while_indents[-1]
 
-        source = self.instructions[self.iptr]
-        if self.count_spaces(source) <= indent:
-            self.while_stack.pop()
-            self.jump_to(row)
+        if self.indents[self.iptr] <= indent:
+            self.while_indents.pop()
+            self.jump_to(self.while_rows[indent])
 
     @property
     def finished(self):
@@ -0,0 +1,233 @@
+import random
+import textwrap
+
+import pytest
+
+import sync
+
+
+def make_sync(tmp_path, program, **options):
+    path = tmp_path / "program.py"
+    path.write_text(textwrap.dedent(program))
+    options.setdefault("roundrobin", True)
+    options.setdefault("max_steps", 1000)
+    return sync.Sync(sync.Options(delay=0, **options), path)
+
+
+def test_else_without_if(tmp_path):
+    sim = make_sync(tmp_path, """\
+        ## Thread A
+        else:
+            x = 1
+        """)
+    with pytest.raises(SyntaxError, match="else does not match if"):
+        sim.run()
+
+
+def test_header_without_colon(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 1
+        ## Thread A
+        if x == 1
+            y = 2
+        """)
+    with pytest.raises(SyntaxError, match="Header must end with :"):
+        sim.run()
+
+
+def test_broken_line_raises_when_run(tmp_path):
+    sim = make_sync(tmp_path, """\
+        ## Thread A
+        x = 1
+        x = = 1
+        """)
+    with pytest.raises(SyntaxError):
+        sim.run()
+    assert sim.locals["x"] == 1
+
+
+def test_broken_line_that_never_runs(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 0
+        ## Thread A
+        if x:
+            x = = 1
+        y = 1
+        """)
+    sim.run()
+    assert sim.locals["y"] == 1
+
+
+def test_one_line_if(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 1
+        ## Thread A
+        if x: y = 1
+        if not x: z = 1
+        w = 1
+        """)
+    sim.run()
+    assert sim.locals["y"] == 1
+    assert "z" not in sim.locals
+    assert sim.locals["w"] == 1
+
+
+def test_verbose_stops_tracking_after_error(tmp_path):
+    sim = make_sync(tmp_path, """\
+        ## Thread A
+        self.x = 1
+        y = 1 / 0
+        """, verbose=True)
+    thread = sim.get_threads()[0]
+    with pytest.raises(ZeroDivisionError):
+        sim.run()
+    assert sim.locals._writes is None
+    assert thread.namespace._writes is None
+
+
+def test_definitions_see_variables_as_they_were(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 1
+        def f():
+            return x
+        def g(): return x
+        h = lambda: x
+        class C:
+            def get(self):
+                return x
+        x = 2
+        ## Thread A
+        seen = (f(), g(), h(), C().get(), x)
+        """)
+    sim.run()
+    assert sim.locals["seen"] == (1, 1, 1, 1, 2)
+
+
+def test_false_if_skips_body_with_blank_lines(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 0
+        ## Thread A
+        if x:
+            a = 1
+
+                b = 1
+
+            c = 1
+        d = 1
+        """)
+    sim.run()
+    assert not {"a", "b", "c"} & sim.locals.keys()
+    assert sim.locals["d"] == 1
+
+
+def test_body_at_end_of_file(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 0
+        ## Thread A
+        if x:
+            a = 1
+        """)
+    thread = sim.get_threads()[0]
+    assert thread.body_ends[0] == len(thread.instructions)
+    sim.run()
+    assert "a" not in sim.locals
+    assert not sim.threads
+
+
+def test_unindented_body_raises_when_header_runs(tmp_path):
+    sim = make_sync(tmp_path, """\
+        x = 0
+        ## Thread A
+        y = 1
+        if x:
+        z = 1
+        """)
+    with pytest.raises(SyntaxError, match="must be indented"):
+        sim.run()
+    assert sim.locals["y"] == 1
+
+
+def test_definition_with_blank_lines(tmp_path):
+    sim = make_sync(tmp_path, """\
+        ## Thread A
+        def f():
+            a = 1
+
+            return a + 1
+        r = f()
+        """)
+    sim.run()
+    assert sim.locals["r"] == 2
+
+
+def test_definition_in_loop_is_compiled_once(tmp_path, monkeypatch):
+    definitions = []
+
+    def counting_compile(source, *args, **kwargs):
+        if source.startswith("def f") and "return" in source:
+            definitions.append(source)
+        return compile(source, *args, **kwargs)
+
+    # Sync.compile looks up compile in the module's globals first
+    monkeypatch.setattr(sync, "compile", counting_compile, raising=False)
+    sim = make_sync(tmp_path, """\
+        i = 0
+        results = []
+        ## Thread A
+        while i < 3:
+            def f(n):
+                return n * 2
+            results.append(f(i))
+            i += 1
+        done = True
+        """)
+    sim.run()
+    assert sim.locals["results"] == [0, 2, 4]
+    assert len(definitions) == 1
+
+
+def check_runnable(sim):
+    assert set(sim.runnable) == {t for t in sim.threads if not t.queued}
+    assert len(sim.runnable_index) == len(sim.runnable)
+    for i, thread in enumerate(sim.runnable):
+        assert sim.runnable_index[thread] == i
+
+
+def test_runnable_threads_match_queued(tmp_path):
+    most_queued = 0
+    for seed in range(20):
+        sim = make_sync(tmp_path, """\
+            sem = Semaphore(0)
+            fifo = FifoSemaphore(0)
+            ## Thread waiter * 4
+            sem.wait()
+            fifo.wait()
+            done = True
+            ## Thread signaller
+            sem.signal(4)
+            fifo.signal(2)
+            fifo.signal(2)
+            """, roundrobin=False)
+        random.seed(seed)
+        check_runnable(sim)
+        while sim.threads:
+            sim.random_step(sim.step_thread)
+            check_runnable(sim)
+            queued = sum(thread.queued for thread in sim.threads)
+            most_queued = max(most_queued, queued)
+        assert sim.locals["done"]
+    # make sure the seeds actually block several threads at once
+    assert most_queued >= 3
+
+
+def test_round_robin_steps_thread_after_one_that_finishes(tmp_path):
+    sim = make_sync(tmp_path, """\
+        ## Thread A
+        a = 1
+        ## Thread B
+        b = 1
+        b = 2
+        """)
+    sim.step(sim.step_thread)
+    assert sim.locals["a"] == 1
+    assert sim.locals["b"] == 1